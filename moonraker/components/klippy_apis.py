@@ -8,19 +8,28 @@ from __future__ import annotations
 from utils import SentinelClass
 from websockets import WebRequest, Subscribable
 import os
-import shutil
+import errno
+import asyncio
 import time
 import logging
 import json
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
 
 # Annotation imports
 from typing import (
     TYPE_CHECKING,
     Any,
+    Awaitable,
     Union,
     Optional,
     Dict,
     List,
+    Set,
+    Tuple,
     TypeVar,
     Mapping,
 )
@@ -29,7 +38,8 @@ if TYPE_CHECKING:
     from websockets import WebRequest
     from klippy_connection import KlippyConnection as Klippy
     from .file_manager.file_manager import FileManager
-    Subscription = Dict[str, Optional[List[Any]]]
+    Subscription = Dict[str, Optional[Set[str]]]
+    QueryArgs = Mapping[str, Optional[List[str]]]
     _T = TypeVar("_T")
 
 INFO_ENDPOINT = "info"
@@ -41,18 +51,114 @@ SUBSCRIPTION_ENDPOINT = "objects/subscribe"
 STATUS_ENDPOINT = "objects/query"
 OBJ_LIST_ENDPOINT = "objects/list"
 REG_METHOD_ENDPOINT = "register_remote_method"
+SDCARD_FMT = 'SDCARD_PRINT_FILE FILENAME="{}"'
+GCODE_ESCAPE = str.maketrans({'"': '\\"', '\\': '\\\\'})
+# Maximum time to wait for additional requests before flushing a batch
+BATCH_MAX_WAIT = .005
+# Time in seconds a cached free space value remains valid
+STATVFS_CACHE_TIME = 30.
 SENTINEL = SentinelClass.get_instance()
+# Constant request parameters shared by all requests.  These must be
+# treated as read-only.
+EMPTY_PARAMS: Dict[str, Any] = {}
+GC_OUTPUT_PARAMS: Dict[str, Any] = {
+    'response_template': {'method': "process_gcode_response"}
+}
+# Errors indicating copy_file_range() is not usable for a pair of files
+COPY_RANGE_FALLBACK_ERRS = (
+    errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP
+)
+
+def _dumps(obj: Any) -> str:
+    # Prefer orjson when available, falling back to the standard
+    # library for objects it can't encode (ie: non-string keys)
+    if HAS_ORJSON:
+        try:
+            return orjson.dumps(obj).decode()
+        except TypeError:
+            pass
+    return json.dumps(obj)
+
+def _link_file(origin: str, target: str) -> bool:
+    # Hard link the file when the target is on the same filesystem.
+    # Returns False if a link could not be created (ie: EXDEV, or
+    # a filesystem without hard link support)
+    for _ in range(2):
+        try:
+            os.link(origin, target)
+        except FileExistsError:
+            os.unlink(target)
+            continue
+        except OSError:
+            return False
+        return True
+    return False
+
+def _kernel_copy(origin: str, target: str) -> None:
+    # Copy a file without passing its contents through user space.
+    # copy_file_range() is attempted first, falling back to sendfile()
+    src = os.open(origin, os.O_RDONLY)
+    try:
+        dst = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            remaining = os.fstat(src).st_size
+            if hasattr(os, "copy_file_range"):
+                try:
+                    while remaining > 0:
+                        copied = os.copy_file_range(src, dst, remaining)
+                        if not copied:
+                            break
+                        remaining -= copied
+                except OSError as e:
+                    if e.errno not in COPY_RANGE_FALLBACK_ERRS:
+                        raise
+            offset = os.lseek(src, 0, os.SEEK_CUR)
+            while remaining > 0:
+                sent = os.sendfile(dst, src, offset, remaining)
+                if not sent:
+                    break
+                offset += sent
+                remaining -= sent
+        finally:
+            os.close(dst)
+    finally:
+        os.close(src)
 
 class KlippyAPI(Subscribable):
     def __init__(self, config: ConfigHelper) -> None:
         self.server = config.get_server()
+        self.eventloop = self.server.get_event_loop()
         self.klippy: Klippy = self.server.lookup_component("klippy_connection")
         self.fm: FileManager = self.server.lookup_component("file_manager")
         app_args = self.server.get_app_args()
         self.version = app_args.get('software_version')
+        # Resolve paths used on print start once rather than per call
+        homedir = os.path.expanduser("~")
+        self._gcode_base = os.path.join(homedir, "gcode_files")
+        self._cache_dir = os.path.join(self._gcode_base, ".cache")
+        self._last_cached_target: Optional[str] = None
+        self._statvfs_cache: Tuple[float, int] = (0., 0)
+        self._cache_lock = asyncio.Lock()
         # Maintain a subscription for all moonraker requests, as
         # we do not want to overwrite them
         self.host_subscription: Subscription = {}
+        # Subscription requests are coalesced into a single request sent
+        # to Klippy.  The flush is deferred to the next loop iteration
+        # each time a request arrives, up to BATCH_MAX_WAIT.
+        self._pending_sub_future: Optional[asyncio.Future] = None
+        self._sub_flush_handle: Optional[asyncio.Handle] = None
+        self._sub_max_wait_handle: Optional[asyncio.TimerHandle] = None
+        # Status queries made in the same loop iteration are batched,
+        # with each waiter receiving the subset of the response it
+        # requested
+        self._pending_query: Dict[str, Optional[Set[str]]] = {}
+        self._query_waiters: List[Tuple[asyncio.Future, QueryArgs]] = []
+        # The object list only changes when Klippy restarts
+        self._obj_list_cache: Optional[List[str]] = None
+        self._reg_method_cache: Dict[str, Dict[str, Any]] = {}
+        self._wr_pool: Dict[str, WebRequest] = {}
+        self.server.register_event_handler(
+            "server:klippy_disconnect", self._handle_klippy_disconnect)
 
         # Register GCode Aliases
         self.server.register_endpoint(
@@ -68,6 +174,25 @@ class KlippyAPI(Subscribable):
         self.server.register_endpoint(
             "/printer/firmware_restart", ['POST'], self._gcode_firmware_restart)
 
+    def _clear_cache_dir(self) -> None:
+        # Remove all regular files from the cache directory.  This is
+        # done on the first print start of a session, after which only
+        # the file cached by this session is tracked and removed.
+        if not os.path.isdir(self._cache_dir):
+            return
+        with os.scandir(self._cache_dir) as it:
+            for entry in it:
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                try:
+                    os.unlink(entry.path)
+                except OSError:
+                    logging.exception(
+                        f"Unable to remove cached file: {entry.path}")
+
+    def _handle_klippy_disconnect(self) -> None:
+        self._obj_list_cache = None
+
     async def _gcode_pause(self, web_request: WebRequest) -> str:
         return await self.pause_print()
 
@@ -92,15 +217,34 @@ class KlippyAPI(Subscribable):
                                    params: Dict[str, Any],
                                    default: Any = SENTINEL
                                    ) -> Any:
+        # All requests share the single persistent Klippy socket owned
+        # by KlippyConnection.  A request never opens a connection, it
+        # fails immediately when Klippy is disconnected and the
+        # connection is only re-established after it has been closed.
         try:
             result = await self.klippy.request(
-                WebRequest(method, params, conn=self))
+                self._get_web_request(method, params))
         except self.server.error:
-            if isinstance(default, SentinelClass):
+            if default is SENTINEL:
                 raise
             result = default
         return result
 
+    def _get_web_request(self,
+                         method: str,
+                         params: Dict[str, Any]
+                         ) -> WebRequest:
+        # Requests with constant parameters reuse a single WebRequest.
+        # Standard Klippy requests do not modify the WebRequest, so
+        # a pooled instance may be shared by concurrent requests.
+        if params is not EMPTY_PARAMS and params is not GC_OUTPUT_PARAMS:
+            return WebRequest(method, params, conn=self)
+        web_request = self._wr_pool.get(method)
+        if web_request is None or web_request.get_args() is not params:
+            web_request = WebRequest(method, params, conn=self)
+            self._wr_pool[method] = web_request
+        return web_request
+
     async def run_gcode(self,
                         script: str,
                         default: Any = SENTINEL
@@ -117,25 +261,37 @@ class KlippyAPI(Subscribable):
         # Doing so will result in "wait_started" blocking for the specifed
         # timeout (default 20s) and returning False.
         # XXX - validate that file is on disk
-        homedir = os.path.expanduser("~")
-        if filename[0] == '/':
+        if filename.startswith('/'):
             filename = filename[1:]
-        # Escape existing double quotes in the file name
-        filename = filename.replace("\"", "\\\"")
-        if os.path.split(filename)[0].split(os.path.sep)[0] != ".cache":
-            base_path = os.path.join(homedir, "gcode_files")
+        if not os.path.basename(filename):
+            raise self.server.error("Invalid filename", 400)
+        if not filename.startswith(".cache" + os.sep):
             target = os.path.join(".cache", os.path.basename(filename))
-            cache_path = os.path.join(base_path, ".cache")
-            if not os.path.exists(cache_path):
-                os.makedirs(cache_path)
-            shutil.rmtree(cache_path)
-            os.makedirs(cache_path)
+            target_full_path = os.path.join(self._gcode_base, target)
             metadata = self.fm.gcode_metadata.metadata.get(filename, None)
-            self.copy_file_to_cache(os.path.join(base_path, filename), os.path.join(base_path, target))
-            msg = "// metadata=" + json.dumps(metadata)
+            # The copy may run in a thread, serialize cache updates so
+            # concurrent print requests can't write the same target
+            async with self._cache_lock:
+                os.makedirs(self._cache_dir, exist_ok=True)
+                last_target = self._last_cached_target
+                if last_target is None:
+                    # First file cached this session, remove any files
+                    # left by a previous session
+                    self._clear_cache_dir()
+                elif os.path.exists(last_target):
+                    # Only the previously cached file needs to be removed
+                    os.unlink(last_target)
+                await self.copy_file_to_cache(
+                    os.path.join(self._gcode_base, filename),
+                    target_full_path)
+                self._last_cached_target = target_full_path
+            msg = "// metadata=" + _dumps(metadata)
             self.server.send_event("server:gcode_response", msg)
             filename = target
-        script = f'SDCARD_PRINT_FILE FILENAME="{filename}"'
+        # Escape existing double quotes and backslashes in the file name
+        if '"' in filename or '\\' in filename:
+            filename = filename.translate(GCODE_ESCAPE)
+        script = SDCARD_FMT.format(filename)
         await self.klippy.wait_started()
         return await self.run_gcode(script)
 
@@ -144,21 +300,21 @@ class KlippyAPI(Subscribable):
     ) -> Union[_T, str]:
         self.server.send_event("klippy_apis:pause_requested")
         return await self._send_klippy_request(
-            "pause_resume/pause", {}, default)
+            "pause_resume/pause", EMPTY_PARAMS, default)
 
     async def resume_print(
         self, default: Union[SentinelClass, _T] = SENTINEL
     ) -> Union[_T, str]:
         self.server.send_event("klippy_apis:resume_requested")
         return await self._send_klippy_request(
-            "pause_resume/resume", {}, default)
+            "pause_resume/resume", EMPTY_PARAMS, default)
 
     async def cancel_print(
         self, default: Union[SentinelClass, _T] = SENTINEL
     ) -> Union[_T, str]:
         self.server.send_event("klippy_apis:cancel_requested")
         return await self._send_klippy_request(
-            "pause_resume/cancel", {}, default)
+            "pause_resume/cancel", EMPTY_PARAMS, default)
 
     async def do_restart(self, gc: str) -> str:
         # WARNING: Do not call this method from within the following
@@ -180,16 +336,16 @@ class KlippyAPI(Subscribable):
                              default: Union[SentinelClass, _T] = SENTINEL
                              ) -> Union[_T, Dict[str, List[str]]]:
         return await self._send_klippy_request(
-            LIST_EPS_ENDPOINT, {}, default)
+            LIST_EPS_ENDPOINT, EMPTY_PARAMS, default)
 
     async def emergency_stop(self) -> str:
-        return await self._send_klippy_request(ESTOP_ENDPOINT, {})
+        return await self._send_klippy_request(ESTOP_ENDPOINT, EMPTY_PARAMS)
 
     async def get_klippy_info(self,
                               send_id: bool = False,
                               default: Union[SentinelClass, _T] = SENTINEL
                               ) -> Union[_T, Dict[str, Any]]:
-        params = {}
+        params = EMPTY_PARAMS
         if send_id:
             ver = self.version
             params = {'client_info': {'program': "Moonraker", 'version': ver}}
@@ -198,9 +354,15 @@ class KlippyAPI(Subscribable):
     async def get_object_list(self,
                               default: Union[SentinelClass, _T] = SENTINEL
                               ) -> Union[_T, List[str]]:
+        if self._obj_list_cache is not None:
+            return list(self._obj_list_cache)
         result = await self._send_klippy_request(
-            OBJ_LIST_ENDPOINT, {}, default)
+            OBJ_LIST_ENDPOINT, EMPTY_PARAMS, default)
         if isinstance(result, dict) and 'objects' in result:
+            # Objects may be added once Klippy exits the startup or
+            # error states, so only cache the list when ready
+            if self.klippy.state == "ready":
+                self._obj_list_cache = list(result['objects'])
             return result['objects']
         return result
 
@@ -208,12 +370,56 @@ class KlippyAPI(Subscribable):
                             objects: Mapping[str, Optional[List[str]]],
                             default: Union[SentinelClass, _T] = SENTINEL
                             ) -> Union[_T, Dict[str, Any]]:
-        params = {'objects': objects}
-        result = await self._send_klippy_request(
-            STATUS_ENDPOINT, params, default)
-        if isinstance(result, dict) and 'status' in result:
-            return result['status']
-        return result
+        for obj, items in objects.items():
+            if obj in self._pending_query:
+                prev = self._pending_query[obj]
+                if items is None or prev is None:
+                    self._pending_query[obj] = None
+                else:
+                    prev.update(items)
+            else:
+                self._pending_query[obj] = (
+                    None if items is None else set(items))
+        if not self._query_waiters:
+            self.eventloop.register_callback(self._flush_query)
+        fut = self.eventloop.create_future()
+        self._query_waiters.append((fut, objects))
+        return await self._wait_batch(fut, default)
+
+    async def _wait_batch(self,
+                          fut: Awaitable[Any],
+                          default: Any = SENTINEL
+                          ) -> Any:
+        try:
+            return await fut
+        except self.server.error:
+            if default is SENTINEL:
+                raise
+            return default
+
+    async def _flush_query(self) -> None:
+        pending = self._pending_query
+        waiters = self._query_waiters
+        self._pending_query = {}
+        self._query_waiters = []
+        objects = {obj: None if fields is None else list(fields)
+                   for obj, fields in pending.items()}
+        try:
+            result = await self._send_klippy_request(
+                STATUS_ENDPOINT, {'objects': objects})
+        except Exception as e:
+            for fut, _ in waiters:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        for fut, req_objs in waiters:
+            if fut.done():
+                continue
+            if isinstance(result, dict) and 'status' in result:
+                status = self._filter_status(result['status'], req_objs)
+                fut.set_result(status)
+            else:
+                fut.set_result(result)
 
     async def subscribe_objects(self,
                                 objects: Mapping[str, Optional[List[str]]],
@@ -225,27 +431,72 @@ class KlippyAPI(Subscribable):
                 if items is None or prev is None:
                     self.host_subscription[obj] = None
                 else:
-                    uitems = list(set(prev) | set(items))
-                    self.host_subscription[obj] = uitems
+                    prev.update(items)
             else:
-                self.host_subscription[obj] = items
-        params = {'objects': self.host_subscription}
-        result = await self._send_klippy_request(
-            SUBSCRIPTION_ENDPOINT, params, default)
+                self.host_subscription[obj] = (
+                    None if items is None else set(items))
+        if self._pending_sub_future is None:
+            self._pending_sub_future = self.eventloop.create_future()
+            self._sub_max_wait_handle = self.eventloop.delay_callback(
+                BATCH_MAX_WAIT, self._flush_subscriptions)
+        if self._sub_flush_handle is not None:
+            self._sub_flush_handle.cancel()
+        self._sub_flush_handle = self.eventloop.call_soon(
+            self._flush_subscriptions)
+        result = await self._wait_batch(
+            asyncio.shield(self._pending_sub_future), default)
         if isinstance(result, dict) and 'status' in result:
-            return result['status']
+            return self._filter_status(result['status'], objects)
         return result
 
+    def _flush_subscriptions(self) -> None:
+        fut = self._pending_sub_future
+        self._pending_sub_future = None
+        for handle in (self._sub_flush_handle, self._sub_max_wait_handle):
+            if handle is not None:
+                handle.cancel()
+        self._sub_flush_handle = self._sub_max_wait_handle = None
+        if fut is not None:
+            self.eventloop.register_callback(self._send_subscription, fut)
+
+    async def _send_subscription(self, fut: asyncio.Future) -> None:
+        objects = {obj: None if fields is None else list(fields)
+                   for obj, fields in self.host_subscription.items()}
+        try:
+            result = await self._send_klippy_request(
+                SUBSCRIPTION_ENDPOINT, {'objects': objects})
+        except Exception as e:
+            fut.set_exception(e)
+        else:
+            fut.set_result(result)
+
+    def _filter_status(self,
+                       status: Dict[str, Any],
+                       objects: QueryArgs
+                       ) -> Dict[str, Any]:
+        # Return the subset of a status response requested by a caller
+        filtered: Dict[str, Any] = {}
+        for obj, fields in objects.items():
+            if obj not in status:
+                continue
+            if fields is None:
+                filtered[obj] = dict(status[obj])
+            else:
+                filtered[obj] = {
+                    k: v for k, v in status[obj].items() if k in fields}
+        return filtered
+
     async def subscribe_gcode_output(self) -> str:
-        template = {'response_template':
-                    {'method': "process_gcode_response"}}
-        return await self._send_klippy_request(GC_OUTPUT_ENDPOINT, template)
+        return await self._send_klippy_request(
+            GC_OUTPUT_ENDPOINT, GC_OUTPUT_PARAMS)
 
     async def register_method(self, method_name: str) -> str:
-        return await self._send_klippy_request(
-            REG_METHOD_ENDPOINT,
-            {'response_template': {"method": method_name},
-             'remote_method': method_name})
+        params = self._reg_method_cache.get(method_name)
+        if params is None:
+            params = {'response_template': {"method": method_name},
+                      'remote_method': method_name}
+            self._reg_method_cache[method_name] = params
+        return await self._send_klippy_request(REG_METHOD_ENDPOINT, params)
 
     def send_status(self,
                     status: Dict[str, Any],
@@ -253,12 +504,28 @@ class KlippyAPI(Subscribable):
                     ) -> None:
         self.server.send_event("server:status_update", status)
 
-    def copy_file_to_cache(self, origin, target):
-        stat = os.statvfs("/")
+    def _get_free_space(self, filesize: int) -> int:
+        # Reuse a recently cached free space value when it is large
+        # enough to satisfy the request, otherwise refresh it
+        last_update, free_space = self._statvfs_cache
+        now = time.monotonic()
+        if now - last_update < STATVFS_CACHE_TIME and filesize < free_space:
+            return free_space
+        stat = os.statvfs(self._cache_dir)
         free_space = stat.f_frsize * stat.f_bfree
-        filesize = os.path.getsize(os.path.join(origin))
+        self._statvfs_cache = (now, free_space)
+        return free_space
+
+    async def copy_file_to_cache(self, origin: str, target: str) -> None:
+        if _link_file(origin, target):
+            return
+        filesize = os.path.getsize(origin)
+        free_space = self._get_free_space(filesize)
         if (filesize < free_space):
-            shutil.copy(origin, target)
+            # Copy in a thread to avoid blocking the event loop
+            await self.eventloop.run_in_thread(_kernel_copy, origin, target)
+            last_update, free_space = self._statvfs_cache
+            self._statvfs_cache = (last_update, free_space - filesize)
         else:
             msg = "!! Insufficient disk space, unable to read the file."
             self.server.send_event("server:gcode_response", msg)
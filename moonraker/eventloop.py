@@ -43,6 +43,7 @@ class EventLoop:
         self.get_loop_time = self.aioloop.time
         self.create_future = self.aioloop.create_future
         self.create_task = self.aioloop.create_task
+        self.call_soon = self.aioloop.call_soon
         self.call_at = self.aioloop.call_at
         self.set_debug = self.aioloop.set_debug
         self.is_running = self.aioloop.is_running
@@ -161,7 +161,9 @@ class KlippyConnection:
             request.notify(ServerError("Klippy Write Request Error", 503))
             if not self.closing:
                 logging.debug("Klippy Disconnection From _write_request()")
-                await self.close()
+                # Shield the close so that a cancelled request cannot
+                # interrupt the disconnect
+                await asyncio.shield(self.close())
 
     def register_remote_method(self,
                                method_name: str,
@@ -519,7 +521,7 @@ class KlippyConnection:
         # Create a base klippy request
         base_request = KlippyRequest(rpc_method, args)
         self.pending_requests[base_request.id] = base_request
-        self.event_loop.register_callback(self._write_request, base_request)
+        await self._write_request(base_request)
         return await base_request.wait()
 
     def remove_subscription(self, conn: Subscribable) -> None:
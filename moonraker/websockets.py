@@ -65,10 +65,12 @@ class WebRequest:
         self.args = args
         self.conn = conn
         self.ip_addr: Optional[IPUnion] = None
-        try:
-            self.ip_addr = ipaddress.ip_address(ip_addr)
-        except Exception:
-            self.ip_addr = None
+        if ip_addr:
+            # Internal requests have no address, skip the failed parse
+            try:
+                self.ip_addr = ipaddress.ip_address(ip_addr)
+            except Exception:
+                self.ip_addr = None
         self.current_user = user
 
     def get_endpoint(self) -> str:
@@ -0,0 +1,99 @@
+from __future__ import annotations
+import os
+import errno
+import pytest
+from utils import ServerError
+from components.klippy_apis import _kernel_copy, _link_file
+
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from pathlib import Path
+    from moonraker import Server
+    from components.klippy_apis import KlippyAPI
+
+TEST_DATA = os.urandom(256 * 1024 + 17)
+
+@pytest.fixture
+def origin(tmp_path: Path) -> Path:
+    src = tmp_path.joinpath("origin.gcode")
+    src.write_bytes(TEST_DATA)
+    return src
+
+def test_kernel_copy(tmp_path: Path, origin: Path):
+    target = tmp_path.joinpath("target.gcode")
+    _kernel_copy(str(origin), str(target))
+    assert target.read_bytes() == TEST_DATA
+
+def test_kernel_copy_replace(tmp_path: Path, origin: Path):
+    target = tmp_path.joinpath("target.gcode")
+    target.write_bytes(b"x" * (len(TEST_DATA) * 2))
+    _kernel_copy(str(origin), str(target))
+    assert target.read_bytes() == TEST_DATA
+
+def test_kernel_copy_fallback(tmp_path: Path, origin: Path,
+                              monkeypatch: pytest.MonkeyPatch):
+    if not hasattr(os, "copy_file_range"):
+        pytest.skip("copy_file_range not available")
+    orig_copy_range = os.copy_file_range
+    calls = []
+
+    def mock_copy_range(src: int, dst: int, count: int) -> int:
+        # Copy part of the file before failing to verify that
+        # sendfile() resumes from the correct offset
+        calls.append(count)
+        if len(calls) > 1:
+            raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+        return orig_copy_range(src, dst, 1000)
+    monkeypatch.setattr(os, "copy_file_range", mock_copy_range)
+    target = tmp_path.joinpath("target.gcode")
+    _kernel_copy(str(origin), str(target))
+    assert len(calls) == 2
+    assert target.read_bytes() == TEST_DATA
+
+def test_kernel_copy_no_copy_range(tmp_path: Path, origin: Path,
+                                   monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.delattr(os, "copy_file_range", raising=False)
+    target = tmp_path.joinpath("target.gcode")
+    _kernel_copy(str(origin), str(target))
+    assert target.read_bytes() == TEST_DATA
+
+def test_kernel_copy_error(tmp_path: Path, origin: Path,
+                           monkeypatch: pytest.MonkeyPatch):
+    def mock_copy_range(src: int, dst: int, count: int) -> int:
+        raise OSError(errno.EIO, os.strerror(errno.EIO))
+    monkeypatch.setattr(os, "copy_file_range", mock_copy_range,
+                        raising=False)
+    target = tmp_path.joinpath("target.gcode")
+    with pytest.raises(OSError):
+        _kernel_copy(str(origin), str(target))
+
+def test_link_file(tmp_path: Path, origin: Path):
+    target = tmp_path.joinpath("target.gcode")
+    assert _link_file(str(origin), str(target))
+    assert target.read_bytes() == TEST_DATA
+    assert os.path.samefile(origin, target)
+
+def test_link_file_replace(tmp_path: Path, origin: Path):
+    target = tmp_path.joinpath("target.gcode")
+    target.write_bytes(b"stale")
+    assert _link_file(str(origin), str(target))
+    assert os.path.samefile(origin, target)
+
+def test_link_file_unsupported(tmp_path: Path, origin: Path,
+                               monkeypatch: pytest.MonkeyPatch):
+    def mock_link(src: str, dst: str) -> None:
+        raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+    monkeypatch.setattr(os, "link", mock_link)
+    target = tmp_path.joinpath("target.gcode")
+    assert not _link_file(str(origin), str(target))
+    assert not target.exists()
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("filename", ["", "/", ".cache/", "subdir/"])
+async def test_start_print_invalid_filename(full_server: Server,
+                                            filename: str):
+    kapis: KlippyAPI = full_server.lookup_component("klippy_apis")
+    with pytest.raises(ServerError) as excinfo:
+        await kapis.start_print(filename)
+    assert excinfo.value.status_code == 400
+    assert kapis._last_cached_target is None
@@ -2,7 +2,7 @@ from __future__ import annotations
 import pytest
 import asyncio
 import pathlib
-from typing import TYPE_CHECKING, Dict
+from typing import TYPE_CHECKING, Dict, List
 from moonraker import ServerError
 from klippy_connection import KlippyRequest
 from mocks import MockReader, MockWriter
@@ -95,6 +95,58 @@ async def test_status_update(ready_server: Server, klippy: KlippyProcess):
     await asyncio.wait_for(fut, 2.)
     assert isinstance(fut.result(), dict)
 
+@pytest.mark.asyncio
+async def test_batched_subscription(ready_server: Server,
+                                    monkeypatch: pytest.MonkeyPatch):
+    kconn = ready_server.klippy_connection
+    kapis = kconn.klippy_apis
+    endpoints: List[str] = []
+    orig_request = kconn.request
+
+    async def mock_request(web_request):
+        endpoints.append(web_request.get_endpoint())
+        return await orig_request(web_request)
+    monkeypatch.setattr(kconn, "request", mock_request)
+    ret = await asyncio.gather(
+        kapis.subscribe_objects({"toolhead": ["position"]}),
+        kapis.subscribe_objects({"toolhead": ["homed_axes", "position"]}),
+        kapis.subscribe_objects({"gcode_move": None})
+    )
+    assert endpoints == ["objects/subscribe"]
+    assert list(ret[0].keys()) == ["toolhead"]
+    assert set(ret[0]["toolhead"].keys()) == {"position"}
+    assert list(ret[1].keys()) == ["toolhead"]
+    assert set(ret[1]["toolhead"].keys()) == {"homed_axes", "position"}
+    assert list(ret[2].keys()) == ["gcode_move"]
+    assert "gcode_position" in ret[2]["gcode_move"]
+
+@pytest.mark.asyncio
+async def test_batched_query(ready_server: Server,
+                             monkeypatch: pytest.MonkeyPatch):
+    kconn = ready_server.klippy_connection
+    kapis = kconn.klippy_apis
+    endpoints: List[str] = []
+    orig_request = kconn.request
+
+    async def mock_request(web_request):
+        endpoints.append(web_request.get_endpoint())
+        return await orig_request(web_request)
+    monkeypatch.setattr(kconn, "request", mock_request)
+    ret = await asyncio.gather(
+        kapis.query_objects({"toolhead": ["position"]}),
+        kapis.query_objects({"toolhead": ["homed_axes"],
+                             "gcode_move": None}),
+        kapis.query_objects({"gcode_move": None})
+    )
+    assert endpoints == ["objects/query"]
+    assert list(ret[0].keys()) == ["toolhead"]
+    assert set(ret[0]["toolhead"].keys()) == {"position"}
+    assert set(ret[1].keys()) == {"toolhead", "gcode_move"}
+    assert set(ret[1]["toolhead"].keys()) == {"homed_axes"}
+    assert list(ret[2].keys()) == ["gcode_move"]
+    assert ret[1]["gcode_move"] == ret[2]["gcode_move"]
+    assert ret[1]["gcode_move"] is not ret[2]["gcode_move"]
+
 @pytest.mark.run_paths(printer_cfg="error_printer.cfg")
 @pytest.mark.asyncio
 async def test_klippy_error(ready_server: Server):
@@ -182,6 +234,25 @@ async def test_write_error(base_server: Server):
     await kconn._write_request(req)
     assert isinstance(req.response, ServerError)
 
+@pytest.mark.asyncio
+async def test_write_error_disconnect(base_server: Server):
+    evtloop = base_server.get_event_loop()
+    fut = evtloop.create_future()
+
+    def on_disconnect():
+        if not fut.done():
+            fut.set_result("disconnect")
+    base_server.register_event_handler(
+        "server:klippy_disconnect", on_disconnect)
+    req = KlippyRequest("", {})
+    kconn = base_server.klippy_connection
+    kconn.writer = MockWriter()
+    await kconn._write_request(req)
+    assert isinstance(req.response, ServerError)
+    assert kconn.writer is None
+    await asyncio.wait_for(fut, 1.)
+    assert fut.result() == "disconnect"
+
 @pytest.mark.asyncio
 async def test_write_cancelled(base_server: Server):
     req = KlippyRequest("", {})